@@ -1,9 +1,16 @@
 import os, sys
+import json
+import shutil
 import threading
 import time
+from collections import deque
+from itertools import islice
 from uuid import uuid4
 
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, Response, render_template, request, jsonify, send_file
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.parser import ParseFailedException
+from streaming_form_data.targets import BaseTarget
 from werkzeug.utils import secure_filename
 
 def resource_path(rel_path: str) -> str:
@@ -33,64 +40,90 @@ def setup_bundled_java() -> str | None:
 
 JAVA_EXE = setup_bundled_java()
 
-import tabula  # noqa: E402
 
-# Пытаемся задать java_path в tabula-py (в 2.10.0 обычно есть tabula.io._java_options)
-try:
-    if JAVA_EXE and hasattr(tabula, "io") and hasattr(tabula.io, "_java_options"):
-        tabula.io._java_options["java_path"] = JAVA_EXE
-except Exception:
-    pass
+def load_processor():
+    """
+    tabula / PyPDF2 / pandas импортируем только при первом запуске обработки:
+    UI открывается сразу, а tabula ищет java уже после setup_bundled_java().
+    """
+    import tabula
+
+    # Пытаемся задать java_path в tabula-py (в 2.10.0 обычно есть tabula.io._java_options)
+    try:
+        if JAVA_EXE and hasattr(tabula, "io") and hasattr(tabula.io, "_java_options"):
+            tabula.io._java_options["java_path"] = JAVA_EXE
+    except Exception:
+        pass
 
-from processor import process_pdfs, to_excel_bytes  # noqa: E402
+    from processor import process_pdfs, to_excel_bytes
+    return process_pdfs, to_excel_bytes
 
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 UPLOAD_DIR = os.path.join(BASE_DIR, "tmp_uploads")
 RESULT_DIR = os.path.join(BASE_DIR, "tmp_results")
+# сюда пишется тело /upload; в UPLOAD_DIR файлы попадают только после успешного разбора
+STAGING_DIR = os.path.join(BASE_DIR, "tmp_staging")
+# разобранные PDF по SHA-256 содержимого; в отличие от загрузок, при очистке не удаляется.
+# В onefile-exe BASE_DIR — временная _MEIPASS, удаляемая при выходе, поэтому кеш — в профиле
+if getattr(sys, "frozen", False):
+    CACHE_DIR = os.path.join(
+        os.environ.get("LOCALAPPDATA") or os.path.dirname(sys.executable),
+        "pdf_to_excel", "cache",
+    )
+else:
+    CACHE_DIR = os.path.join(BASE_DIR, "tmp_cache")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(RESULT_DIR, exist_ok=True)
+os.makedirs(CACHE_DIR, exist_ok=True)
 
 app = Flask(__name__, template_folder="templates", static_folder="static")
 app.config["MAX_CONTENT_LENGTH"] = 200 * 1024 * 1024  # 200MB
 
+LOG_LIMIT = 2000
+SSE_KEEPALIVE = 15  # сек, комментарий-пинг в /events, чтобы замечать отвалившихся клиентов
+
 STATE = {
     "running": False,
-    "logs": [],
+    "logs": deque(maxlen=LOG_LIMIT),
+    "log_seq": 0,  # сколько строк добавлено за всё время — /events по нему отдаёт только новые
+    "log_epoch": 0,  # меняется при очистке логов — /events шлёт клиенту reset
     "result_file": None,
     "job_id": None,
+    # публикуется под _state_lock только когда /upload целиком завершился
     "uploaded_files": [],
 }
 
+# STATE меняют и запросы Flask, и фоновый _worker — все изменения под одной блокировкой;
+# RLock, т.к. cleanup_all вызывается и изнутри уже захваченной секции
+_state_lock = threading.RLock()
+# будит /events при новой строке лога или очистке
+_log_cond = threading.Condition(_state_lock)
+
 
 def add_log(line: str):
     ts = time.strftime("%H:%M:%S")
-    STATE["logs"].append(f"[{ts}] {line}")
+    with _log_cond:
+        STATE["logs"].append(f"[{ts}] {line}")
+        STATE["log_seq"] += 1
+        _log_cond.notify_all()
 
 
 def cleanup_all():
-    # удаление загруженных pdf
-    for p in STATE.get("uploaded_files") or []:
-        try:
-            if p and os.path.exists(p):
-                os.remove(p)
-        except Exception:
-            pass
-
-    # удаление результата
-    try:
-        p = STATE.get("result_file")
-        if p and os.path.exists(p):
-            os.remove(p)
-    except Exception:
-        pass
-
-    # очистка состояния
-    STATE["uploaded_files"] = []
-    STATE["result_file"] = None
-    STATE["logs"] = []
-    STATE["job_id"] = None
-    STATE["running"] = False
+    with _state_lock:
+        # загрузки и результаты живут в своих каталогах — сносим их целиком
+        for d in (UPLOAD_DIR, RESULT_DIR):
+            shutil.rmtree(d, ignore_errors=True)
+            os.makedirs(d, exist_ok=True)
+
+        # очистка состояния
+        STATE["uploaded_files"] = []
+        STATE["result_file"] = None
+        STATE["job_id"] = None
+        STATE["running"] = False
+        STATE["logs"].clear()
+        STATE["log_epoch"] += 1
+        _log_cond.notify_all()
 
 
 @app.get("/")
@@ -98,43 +131,101 @@ def index():
     return render_template("index.html")
 
 
-@app.post("/upload")
-def upload():
-    if STATE["running"]:
-        return jsonify({"ok": False, "error": "Нельзя загружать во время обработки"}), 409
+UPLOAD_CHUNK = 64 * 1024
 
-    files = request.files.getlist("files")
-    if not files:
-        return jsonify({"ok": False, "error": "Файлы не выбраны"}), 400
 
-    # новая загрузка — чистим хвосты от предыдущих запусков
-    cleanup_all()
+class PdfUploadTarget(BaseTarget):
+    """
+    Пишет части multipart поля "files" сразу в dest_dir (без буфера werkzeug и f.save()).
+    Не-PDF части читаются и отбрасываются.
+    """
 
-    saved = []
-    skipped = 0
+    def __init__(self, dest_dir: str):
+        super().__init__()
+        self.dest_dir = dest_dir
+        self.saved = []
+        self.skipped = 0
+        self._fd = None
 
-    for f in files:
-        name = secure_filename(f.filename or "")
+    def on_start(self):
+        name = secure_filename(self.multipart_filename or "")
         if not name.lower().endswith(".pdf"):
-            skipped += 1
-            continue
-        uid = uuid4().hex
-        path = os.path.join(UPLOAD_DIR, f"{uid}_{name}")
-        f.save(path)
-        saved.append(path)
-
-    if not saved:
-        return jsonify({"ok": False, "error": "Нет PDF для обработки"}), 400
-
-    STATE["uploaded_files"] = saved
-    add_log(f"Загружено PDF: {len(saved)} (пропущено не-PDF: {skipped})")
+            self.skipped += 1
+            return
+        path = os.path.join(self.dest_dir, f"{len(self.saved):04d}_{name}")
+        self._fd = open(path, "wb")
+        self.saved.append(path)
+
+    def on_data_received(self, chunk: bytes):
+        if self._fd:
+            self._fd.write(chunk)
+
+    def on_finish(self):
+        if self._fd:
+            self._fd.close()
+            self._fd = None
+
+
+@app.post("/upload")
+def upload():
+    with _state_lock:
+        if STATE["running"]:
+            return jsonify({"ok": False, "error": "Нельзя загружать во время обработки"}), 409
+
+    # явно плохие запросы отбиваем до чтения тела — предыдущая загрузка при этом остаётся
+    if request.mimetype != "multipart/form-data":
+        return jsonify({"ok": False, "error": "Некорректный запрос загрузки"}), 400
+    max_len = app.config["MAX_CONTENT_LENGTH"]
+    if max_len and request.content_length and request.content_length > max_len:
+        return jsonify({"ok": False, "error": "Слишком большой объём загрузки"}), 413
+
+    # пишем файлы прямо из потока запроса во временный каталог, одним проходом;
+    # прошлую загрузку заменяем только когда новая целиком принята
+    staging = os.path.join(STAGING_DIR, uuid4().hex)
+    os.makedirs(staging, exist_ok=True)
+    target = PdfUploadTarget(staging)
+    try:
+        try:
+            parser = StreamingFormDataParser(headers=request.headers)
+            parser.register("files", target)
+            while chunk := request.stream.read(UPLOAD_CHUNK):
+                parser.data_received(chunk)
+        except ParseFailedException:
+            return jsonify({"ok": False, "error": "Некорректный запрос загрузки"}), 400
+        finally:
+            target.on_finish()
+
+        saved = target.saved
+        skipped = target.skipped
+        if not saved and not skipped:
+            return jsonify({"ok": False, "error": "Файлы не выбраны"}), 400
+
+        if not saved:
+            return jsonify({"ok": False, "error": "Нет PDF для обработки"}), 400
+
+        with _state_lock:
+            if STATE["running"]:
+                return jsonify({"ok": False, "error": "Нельзя загружать во время обработки"}), 409
+
+            # новая загрузка — чистим хвосты от предыдущих запусков и подкладываем новые файлы
+            cleanup_all()
+            files = []
+            for p in saved:
+                files.append(os.path.join(UPLOAD_DIR, os.path.basename(p)))
+                os.replace(p, files[-1])
+            STATE["uploaded_files"] = files
+            add_log(f"Загружено PDF: {len(saved)} (пропущено не-PDF: {skipped})")
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
     return jsonify({"ok": True, "count": len(saved)})
 
 
 def _worker(file_paths):
     try:
         add_log("Старт обработки...")
-        df = process_pdfs(file_paths, log=add_log)
+        process_pdfs, to_excel_bytes = load_processor()
+        df = process_pdfs(file_paths, log=add_log, cache_dir=CACHE_DIR)
 
         xlsx_bytes = to_excel_bytes(df)
         out_name = f"result_{uuid4().hex}.xlsx"
@@ -142,42 +233,98 @@ def _worker(file_paths):
         with open(out_path, "wb") as f:
             f.write(xlsx_bytes)
 
-        STATE["result_file"] = out_path
+        with _state_lock:
+            STATE["result_file"] = out_path
         add_log("Excel сформирован. Можно скачивать.")
     except Exception as e:
         add_log(f"ERROR: {e}")
     finally:
-        STATE["running"] = False
+        with _state_lock:
+            STATE["running"] = False
         add_log("Завершено.")
 
 
 @app.post("/start")
 def start():
-    if STATE["running"]:
-        return jsonify({"ok": False, "error": "Уже выполняется"}), 409
+    # проверка и захват "running" атомарно — два /start подряд не запустят два воркера
+    with _state_lock:
+        if STATE["running"]:
+            return jsonify({"ok": False, "error": "Уже выполняется"}), 409
 
-    files = STATE.get("uploaded_files") or []
-    if not files:
-        return jsonify({"ok": False, "error": "Сначала загрузите PDF"}), 400
+        files = list(STATE["uploaded_files"])
+        if not files:
+            return jsonify({"ok": False, "error": "Сначала загрузите PDF"}), 400
 
-    STATE["running"] = True
-    STATE["result_file"] = None
-    STATE["job_id"] = uuid4().hex
-    add_log("Запущена задача...")
+        STATE["running"] = True
+        STATE["result_file"] = None
+        job_id = STATE["job_id"] = uuid4().hex
+        add_log("Запущена задача...")
 
     t = threading.Thread(target=_worker, args=(files,), daemon=True)
     t.start()
-    return jsonify({"ok": True, "job_id": STATE["job_id"]})
+    return jsonify({"ok": True, "job_id": job_id})
 
 
-@app.get("/status")
-def status():
-    return jsonify({
+def _status() -> dict:
+    return {
         "running": STATE["running"],
-        "logs": STATE["logs"][-800:],
         "has_result": STATE["result_file"] is not None,
-        "uploaded": len(STATE.get("uploaded_files") or []),
-    })
+        "uploaded": len(STATE["uploaded_files"]),
+    }
+
+
+@app.get("/status")
+def status():
+    with _state_lock:
+        payload = _status()
+        payload["logs"] = list(islice(STATE["logs"], max(0, len(STATE["logs"]) - 800), None))
+    return jsonify(payload)
+
+
+def _sse(data, event: str | None = None) -> str:
+    head = f"event: {event}\n" if event else ""
+    return f"{head}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.get("/events")
+def events():
+    """
+    Server-Sent Events: отдаём только новые строки лога (и статус после них),
+    вместо того чтобы фронт каждые N мс забирал весь хвост логов через /status.
+    """
+    def gen():
+        epoch, seq = None, 0
+        while True:
+            with _log_cond:
+                _log_cond.wait_for(
+                    lambda: STATE["log_epoch"] != epoch or STATE["log_seq"] != seq,
+                    timeout=SSE_KEEPALIVE,
+                )
+                logs = STATE["logs"]
+                reset = STATE["log_epoch"] != epoch
+                if reset:
+                    lines = list(logs)
+                else:
+                    fresh = min(STATE["log_seq"] - seq, len(logs))
+                    lines = list(islice(logs, len(logs) - fresh, None))
+                epoch, seq = STATE["log_epoch"], STATE["log_seq"]
+                st = _status()
+
+            if not reset and not lines:
+                yield ": ping\n\n"
+                continue
+
+            if reset:
+                yield _sse(None, "reset")
+            for line in lines:
+                yield _sse(line)
+            yield _sse(st, "status")
+
+    return Response(
+        gen(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @app.get("/download")
@@ -200,9 +347,10 @@ def download():
 @app.post("/reset")
 def reset():
     # нельзя сбрасывать во время выполнения
-    if STATE["running"]:
-        return jsonify({"ok": False, "error": "Нельзя очищать во время обработки"}), 409
-    cleanup_all()
+    with _state_lock:
+        if STATE["running"]:
+            return jsonify({"ok": False, "error": "Нельзя очищать во время обработки"}), 409
+        cleanup_all()
     return jsonify({"ok": True})
 
 
@@ -221,9 +369,13 @@ def shutdown():
 
 
 if __name__ == "__main__":
+    import multiprocessing
     import webbrowser
     from threading import Timer
 
+    # нужно для ProcessPoolExecutor внутри onefile-exe (PyInstaller)
+    multiprocessing.freeze_support()
+
     def open_browser():
         webbrowser.open("http://127.0.0.1:5000")
 
@@ -1,25 +1,69 @@
+import hashlib
+import multiprocessing
 import os
-import re
-from typing import Optional, List, Tuple, Callable
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from typing import TYPE_CHECKING, Optional, List, Tuple, Callable
 
 import pandas as pd
-from PyPDF2 import PdfReader
-import tabula
+import pyarrow as pa
+import pyarrow.compute as pc
 
-DOCNO_RE_1 = re.compile(r"Номер\s+документа.*?(\d{4,9})", re.IGNORECASE | re.DOTALL)
-DOCNO_RE_2 = re.compile(r"(\d{1,9})\s+\d{2}\.\d{2}\.\d{4}")
+if TYPE_CHECKING:
+    # в рантайме PyPDF2 и tabula импортируются внутри функций — они нужны только воркерам
+    from PyPDF2 import PdfReader
+
+# google-re2 (закреплён в requirements, вшит в exe): линейное время без backtracking на ".*?"
+import re2 as re
+
+# флаги inline ((?is)): re2 не принимает флаги re.
+# \s и \d в re2 — только ASCII, поэтому пробел и цифры — как у \s/\d в обычном re:
+# \pZ (NBSP, U+2009, U+202F, ...) + \v, \x1c-\x1f, \x85; цифры — \p{Nd}
+_WS = r"[\s\pZ\x0b\x1c-\x1f\x85]"
+DOCNO_RE_1 = re.compile(rf"(?is)Номер{_WS}+документа.*?(\p{{Nd}}{{4,9}})")
+DOCNO_RE_2 = re.compile(rf"(\p{{Nd}}{{1,9}}){_WS}+\p{{Nd}}{{2}}\.\p{{Nd}}{{2}}\.\p{{Nd}}{{4}}")
+
+# строки на Arrow: один непрерывный буфер вместо массива PyObject,
+# str.* и regex уходят в pyarrow.compute
+STRING_DTYPE = pd.StringDtype("pyarrow")
+
+# каждый воркер поднимает свою JVM под tabula — больше 4 упираемся в память
+MAX_WORKERS = 4
+
+# пул живёт между запусками: с jpype JVM стартует один раз на воркер
+# и переиспользуется для всех последующих PDF (а не java-процесс на каждый файл)
+_EXECUTOR: Optional[ProcessPoolExecutor] = None
+
+# менять при изменении логики разбора — старые записи кеша перестанут находиться
+CACHE_VERSION = 2
+# кеш чистится при каждом запуске: старше CACHE_MAX_AGE и сверх CACHE_MAX_ENTRIES (самые давние)
+CACHE_MAX_ENTRIES = 500
+CACHE_MAX_AGE = 30 * 24 * 3600  # сек
+
+
+# номер документа всегда в шапке — дальше первых страниц текст не разбираем
+DOCNO_PAGES = 2
 
 
 def extract_doc_number(pdf_path: str) -> Optional[str]:
-    reader = PdfReader(pdf_path)
-    text = "\n".join((page.extract_text() or "") for page in reader.pages)
+    from PyPDF2 import PdfReader
 
-    m = DOCNO_RE_1.search(text)
-    if m:
-        return m.group(1)
+    return _read_doc_number(PdfReader(pdf_path))
 
-    m = DOCNO_RE_2.search(text)
-    return m.group(1) if m else None
+
+def _read_doc_number(reader: "PdfReader") -> Optional[str]:
+    parts: List[str] = []
+    for page in reader.pages[:DOCNO_PAGES]:
+        parts.append(page.extract_text() or "")
+        text = "\n".join(parts)
+
+        m = DOCNO_RE_1.search(text) or DOCNO_RE_2.search(text)
+        if m:
+            return m.group(1)
+
+    return None
 
 
 def _choose_and_clean_table(tables: List[pd.DataFrame]) -> Optional[pd.DataFrame]:
@@ -35,36 +79,61 @@ def _choose_and_clean_table(tables: List[pd.DataFrame]) -> Optional[pd.DataFrame
         if len(tbl) <= 5 or len(tbl.columns) <= 2:
             continue
 
+        # срез без copy(): отвергнутые таблицы не копируются,
+        # принятая всё равно получает новый объект через reset_index
         start, end = slice_rules.get(i, default_slice)
-        df = tbl.iloc[start:end].copy()
-        if df.empty or len(df) < 2:
+        df = tbl.iloc[start:end]
+        if len(df) < 2:
             continue
 
-        df.columns = df.iloc[0]
+        cols = df.iloc[0].tolist()
         df = df.iloc[1:].reset_index(drop=True)
+        df.columns = cols
         return df
 
     return None
 
 
-def extract_table(pdf_path: str) -> Optional[pd.DataFrame]:
-    tables = tabula.read_pdf(pdf_path, pages="all", multiple_tables=True)
+# нужная таблица почти всегда на первых страницах — сначала отдаём tabula только их
+TABLE_FIRST_PAGES = 3
+
+
+def extract_table(pdf_path: str, n_pages: Optional[int] = None) -> Optional[pd.DataFrame]:
+    import tabula
+
+    if not n_pages or n_pages <= TABLE_FIRST_PAGES:
+        tables = tabula.read_pdf(pdf_path, pages="all", multiple_tables=True)
+        return _choose_and_clean_table(tables)
+
+    # tabula отдаёт таблицы в порядке страниц, поэтому индексы (slice_rules) те же,
+    # что и при pages="all"; остальные страницы читаем, только если на первых не нашли
+    tables = tabula.read_pdf(pdf_path, pages=f"1-{TABLE_FIRST_PAGES}", multiple_tables=True)
+    df = _choose_and_clean_table(tables)
+    if df is not None:
+        return df
+
+    tables += tabula.read_pdf(pdf_path, pages=f"{TABLE_FIRST_PAGES + 1}-{n_pages}", multiple_tables=True)
     return _choose_and_clean_table(tables)
 
 
 def clean_text_series(s: pd.Series) -> pd.Series:
-    s = s.astype("string").fillna("").str.replace(r"\s+", " ", regex=True).str.strip()
+    # regex выполняет RE2 (pyarrow), там \s только ASCII — NBSP и прочие пробелы через \pZ
+    s = s.astype(STRING_DTYPE).fillna("").str.replace(r"[\s\pZ]+", " ", regex=True).str.strip()
     s = s.replace({"": pd.NA})
     return s
 
 
 def clean_code_series(s: pd.Series) -> pd.Series:
-    s = s.astype("string").fillna("").str.strip()
+    s = s.astype(STRING_DTYPE).fillna("").str.strip()
     s = s.str.replace(r"\.0$", "", regex=True)
     s = s.replace({"": pd.NA})
     return s
 
 
+# строка целиком — десятичное число (пробелы и запятые к этому моменту уже убраны)
+_NUMBER_RE = r"^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$"
+
+
 def _to_number_series(s: pd.Series) -> pd.Series:
     """
     Преобразует строковые значения вида:
@@ -72,25 +141,35 @@ def _to_number_series(s: pd.Series) -> pd.Series:
       "1234" -> 1234
       ""/текст -> NaN
     """
-    x = s.astype("string").fillna("")
-    x = x.str.replace("\u00A0", " ", regex=False)  # NBSP
-    x = x.str.replace(" ", "", regex=False)
-    x = x.str.replace(",", ".", regex=False)
-    return pd.to_numeric(x, errors="coerce")
+    # NBSP и пробелы убираем, запятую -> точка; оба шага — векторные kernels pyarrow.compute
+    # (str.translate в Arrow нет, он вызывался бы из python на каждую строку)
+    x = s.astype(STRING_DTYPE).fillna("")
+    x = x.str.replace("[\u00A0 ]", "", regex=True).str.replace(",", ".", regex=False)
+
+    # разбор целиком в Arrow (C++): не-числа -> null, остальное cast в float64;
+    # pd.to_numeric здесь гонял бы каждую строку через python-объект
+    arr = pa.array(x.array)
+    arr = pc.if_else(pc.match_substring_regex(arr, _NUMBER_RE), arr, pa.scalar(None, pa.string()))
+    values = pc.cast(arr, pa.float64()).to_numpy(zero_copy_only=False)
+    return pd.Series(values, index=s.index, name=s.name, dtype="Float64")
 
 
 def build_doc_df(pdf_path: str) -> Tuple[Optional[pd.DataFrame], Optional[str]]:
     """
-    Возвращает df формата:
-      код | наименование | <doc_number>
+    Возвращает df в long-формате (схема одинакова для всех PDF):
+      код | наименование | doc_number | value
 
     ВАЖНО: строки с одинаковым "код" внутри одного PDF суммируются.
     """
-    doc_number = extract_doc_number(pdf_path)
+    from PyPDF2 import PdfReader
+
+    # PDF открываем один раз; tabula дёргаем только если номер документа найден
+    reader = PdfReader(pdf_path)
+    doc_number = _read_doc_number(reader)
     if not doc_number:
         return None, None
 
-    df = extract_table(pdf_path)
+    df = extract_table(pdf_path, n_pages=len(reader.pages))
     if df is None:
         return None, doc_number
 
@@ -100,24 +179,26 @@ def build_doc_df(pdf_path: str) -> Tuple[Optional[pd.DataFrame], Optional[str]]:
         raise ValueError(f"{pdf_path}: нет колонок {missing}. Доступны: {list(df.columns)}")
 
     df = df.loc[:, required].copy()
-    df.columns = ["наименование", "код", doc_number]
+    df.columns = ["наименование", "код", "value"]
 
     df["наименование"] = clean_text_series(df["наименование"])
     df["код"] = clean_code_series(df["код"])
-    df[doc_number] = clean_text_series(df[doc_number])
+    df["value"] = clean_text_series(df["value"])
 
     df = df.dropna(subset=["код"])
 
     # значения документа -> число, далее суммируем по одинаковому коду
-    df[doc_number] = _to_number_series(df[doc_number])
+    df["value"] = _to_number_series(df["value"])
 
+    # "first" берёт первое непустое значение в группе (cython-агрегация, без lambda на группу)
     df = (
         df.groupby("код", as_index=False)
         .agg({
-            "наименование": lambda x: x.dropna().iloc[0] if len(x.dropna()) else pd.NA,
-            doc_number: "sum",
+            "наименование": "first",
+            "value": "sum",
         })
     )
+    df.insert(2, "doc_number", doc_number)
 
     return df, doc_number
 
@@ -134,7 +215,7 @@ def add_totals(final_df: pd.DataFrame) -> pd.DataFrame:
 
     # сортировка по коду (пытаемся как число, иначе как строка)
     df = final_df.copy()
-    code_num = pd.to_numeric(df["код"].astype("string"), errors="coerce")
+    code_num = pd.to_numeric(df["код"].astype(STRING_DTYPE), errors="coerce")
     df = df.assign(_code_num=code_num)
     df = df.sort_values(by=["_code_num", "код"], ascending=True, na_position="last").drop(columns=["_code_num"])
 
@@ -152,10 +233,116 @@ def add_totals(final_df: pd.DataFrame) -> pd.DataFrame:
 
 
 
-def process_pdfs(file_paths: List[str], log: Optional[Callable[[str], None]] = None) -> pd.DataFrame:
+def _file_sha256(path: str) -> str:
+    with open(path, "rb") as f:
+        if hasattr(hashlib, "file_digest"):  # Python 3.11+
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        h = hashlib.sha256()
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+        return h.hexdigest()
+
+
+def _prune_cache(cache_dir: str) -> int:
+    """
+    Удаляет из кеша записи старше CACHE_MAX_AGE, другой CACHE_VERSION и всё сверх
+    CACHE_MAX_ENTRIES (по времени последнего использования). Возвращает число удалённых.
+    """
+    os.makedirs(cache_dir, exist_ok=True)  # нет каталога — пустой кеш, воркерам есть куда писать
+    suffix = f".v{CACHE_VERSION}.pkl"
+    now = time.time()
+    keep, drop = [], []
+    with os.scandir(cache_dir) as it:
+        for e in it:
+            if not e.is_file():
+                continue
+            mtime = e.stat().st_mtime
+            if not e.name.endswith(suffix) or now - mtime > CACHE_MAX_AGE:
+                # чужая версия / брошенный .tmp / устаревшая запись
+                # (свежие .tmp может прямо сейчас писать воркер — их не трогаем)
+                if not e.name.endswith(".tmp") or now - mtime > 3600:
+                    drop.append(e.path)
+            else:
+                keep.append((mtime, e.path))
+
+    keep.sort(reverse=True)
+    drop.extend(p for _, p in keep[CACHE_MAX_ENTRIES:])
+
+    removed = 0
+    for p in drop:
+        try:
+            os.remove(p)
+            removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+def _process_one(
+    pdf_path: str, cache_dir: Optional[str] = None
+) -> Tuple[str, Optional[pd.DataFrame], Optional[str], bool, str]:
+    """
+    Обработка одного PDF в отдельном процессе (функция верхнего уровня — чтобы пиклилась).
+    Если задан cache_dir — результат кешируется по SHA-256 содержимого PDF,
+    повторно загруженный тот же файл не разбирается заново.
+    Последние элементы — взят ли результат из кеша и SHA-256 файла.
+    """
+    sha = _file_sha256(pdf_path)
+    if not cache_dir:
+        dfi, docno = build_doc_df(pdf_path)
+        return pdf_path, dfi, docno, False, sha
+
+    cache_path = os.path.join(cache_dir, f"{sha}.v{CACHE_VERSION}.pkl")
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, "rb") as f:
+                dfi, docno = pickle.load(f)
+            os.utime(cache_path)  # mtime = последнее использование, для _prune_cache
+            return pdf_path, dfi, docno, True, sha
+        except Exception:
+            pass  # битый кеш — просто пересчитываем
+
+    dfi, docno = build_doc_df(pdf_path)
+
+    # пишем через временный файл: тот же PDF может параллельно считать другой воркер
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            pickle.dump((dfi, docno), f)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+
+    return pdf_path, dfi, docno, False, sha
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _EXECUTOR
+    if _EXECUTOR is None:
+        workers = max(1, min(os.cpu_count() or 1, MAX_WORKERS))
+        # spawn, а не fork: пул поднимается из многопоточного Flask-процесса
+        # (fork копирует чужие захваченные локи); на Windows spawn и так по умолчанию
+        _EXECUTOR = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _EXECUTOR
+
+
+def _drop_executor():
+    global _EXECUTOR
+    if _EXECUTOR is not None:
+        _EXECUTOR.shutdown(wait=False, cancel_futures=True)
+        _EXECUTOR = None
+
+
+def process_pdfs(
+    file_paths: List[str],
+    log: Optional[Callable[[str], None]] = None,
+    cache_dir: Optional[str] = None,
+) -> pd.DataFrame:
     """
     Обрабатывает несколько PDF:
-      - для каждого PDF строит таблицу по "коду"
+      - для каждого PDF строит таблицу по "коду" (с cache_dir — кеш по SHA-256 файла)
       - объединяет по коду (outer)
       - добавляет итоги
     """
@@ -165,21 +352,70 @@ def process_pdfs(file_paths: List[str], log: Optional[Callable[[str], None]] = N
 
     _log(f"Файлов получено: {len(file_paths)}")
 
+    if cache_dir:
+        removed = _prune_cache(cache_dir)
+        if removed:
+            _log(f"Кеш: удалено устаревших записей: {removed}")
+
+    # PDF независимы друг от друга — разбираем параллельно,
+    # логируем из основного процесса по мере готовности (log не пиклится)
+    results = {}
+    ex = _get_executor()
+    futures = {ex.submit(_process_one, p, cache_dir): p for p in file_paths}
+    try:
+        for fut in as_completed(futures):
+            path = futures[fut]
+            _log(f"Обработка: {os.path.basename(path)}")
+            try:
+                _, dfi, docno, cached, sha = fut.result()
+            except BrokenProcessPool:
+                raise
+            except Exception as e:
+                # исключение из воркера не знает, какой файл он разбирал — добавляем имя
+                raise RuntimeError(f"{os.path.basename(path)}: {e}") from e
+            results[path] = (dfi, docno, sha)
+
+            if cached:
+                _log("  из кеша (файл с таким содержимым уже разбирался)")
+            if docno is None:
+                _log("  WARN: не найден номер документа, файл пропущен")
+            elif dfi is None:
+                _log(f"  WARN: таблица не извлечена (doc={docno}), файл пропущен")
+            else:
+                _log(f"  OK: doc={docno}, уникальных кодов={len(dfi)}")
+    except BrokenProcessPool:
+        # воркер упал (например, JVM) — следующий запуск поднимет пул заново
+        _drop_executor()
+        raise
+    except Exception:
+        for fut in futures:
+            fut.cancel()
+        raise
+
+    # порядок документных колонок — как у входных файлов, а не как завершились процессы
     doc_dfs: List[pd.DataFrame] = []
-
+    doc_order: List[str] = []
+    seen_files = {}  # sha256 -> имя файла
+    seen_docs = set()
     for path in file_paths:
-        _log(f"Обработка: {os.path.basename(path)}")
-
-        dfi, docno = build_doc_df(path)
-        if docno is None:
-            _log("  WARN: не найден номер документа, файл пропущен")
+        dfi, docno, sha = results[path]
+        if docno is None or dfi is None:
             continue
-        if dfi is None:
-            _log(f"  WARN: таблица не извлечена (doc={docno}), файл пропущен")
+        name = os.path.basename(path)
+        # тот же файл дважды (обычно повторно брошенный PDF) не суммируем молча
+        if sha in seen_files:
+            _log(f"WARN: {name} совпадает с {seen_files[sha]}, файл пропущен")
             continue
-
-        _log(f"  OK: doc={docno}, уникальных кодов={len(dfi)}")
+        seen_files[sha] = name
+        # разные файлы с одним номером документа — отдельной колонкой, ничего не теряем
+        if docno in seen_docs:
+            label = f"{docno} ({name})"
+            _log(f"WARN: doc={docno} уже загружен другим файлом, колонка {label}")
+            dfi = dfi.assign(doc_number=label)
+            docno = label
+        seen_docs.add(docno)
         doc_dfs.append(dfi)
+        doc_order.append(docno)
 
     if not doc_dfs:
         final_df = pd.DataFrame(columns=["наименование", "код"])
@@ -188,55 +424,69 @@ def process_pdfs(file_paths: List[str], log: Optional[Callable[[str], None]] = N
         return final_df
 
     # 1) Собираем "справочник" код -> наименование (первое непустое)
-    names = pd.concat([d[["код", "наименование"]] for d in doc_dfs], ignore_index=True)
-    names = names.dropna(subset=["код"])
-    names = (
-        names.groupby("код", as_index=False)["наименование"]
-        .agg(lambda x: x.dropna().iloc[0] if len(x.dropna()) else pd.NA)
+    #    словарём за один проход по документам, без общего concat + groupby
+    names_map = {}
+    for dfi in doc_dfs:
+        for code, name in zip(dfi["код"], dfi["наименование"]):
+            if pd.isna(code):
+                continue
+            if names_map.get(code) is None:
+                names_map[code] = None if pd.isna(name) else name
+    names = pd.DataFrame(
+        {"код": list(names_map), "наименование": list(names_map.values())},
+        dtype=STRING_DTYPE,
     )
 
-    # 2) Объединяем документные колонки по коду
-    merged = names[["код", "наименование"]].copy()
-    for dfi in doc_dfs:
-        doc_cols = [c for c in dfi.columns if c not in ("код", "наименование")]
-        if not doc_cols:
-            continue
-        doc_col = doc_cols[0]
-        merged = merged.merge(dfi[["код", doc_col]], on="код", how="outer")
+    # 2) Документные колонки: все PDF уже в long-формате — один concat и один pivot
+    #    вместо цепочки outer-merge по каждому документу
+    wide = (
+        pd.concat(doc_dfs, ignore_index=True)
+        .pivot_table(index="код", columns="doc_number", values="value", aggfunc="sum")
+        .reindex(columns=list(dict.fromkeys(doc_order)))  # порядок — как у входных файлов
+    )
+    wide.columns.name = None
 
-    # порядок колонок
-    doc_cols_all = [c for c in merged.columns if c not in ("код", "наименование")]
-    final_df = merged[["наименование", "код"] + doc_cols_all]
+    merged = names.merge(wide.reset_index(), on="код", how="outer")
+    final_df = merged[["наименование", "код"] + list(wide.columns)]
 
     final_df = add_totals(final_df)
     _log(f"Готово. Итоговых строк (вкл. итоги): {len(final_df)}")
     return final_df
 
 
+def _column_widths(df: pd.DataFrame) -> pd.Series:
+    """
+    Ширина колонок по максимальной длине значения (включая заголовок),
+    с небольшим запасом и ограничением сверху. Считается по колонкам, а не по ячейкам.
+    """
+    data_max = pd.Series(
+        [df.iloc[:, i].astype(STRING_DTYPE).str.len().max() for i in range(df.shape[1])],
+        dtype="Float64",
+    ).fillna(0)
+    header_max = pd.Series([len(str(c)) if c is not None else 0 for c in df.columns], dtype="float64")
+    widths = pd.concat([data_max, header_max], axis=1).max(axis=1)
+    return (widths + 2).clip(upper=60).astype(int)
+
+
 def to_excel_bytes(df: pd.DataFrame) -> bytes:
     import io
+    from openpyxl import Workbook
     from openpyxl.utils import get_column_letter
+    from openpyxl.utils.dataframe import dataframe_to_rows
 
-    bio = io.BytesIO()
-    with pd.ExcelWriter(bio, engine="openpyxl") as writer:
-        df.to_excel(writer, index=False, sheet_name="result")
-
-        ws = writer.book["result"]
-
-        # авто-ширина по максимальной длине значения в колонке
-        for col_idx, col_name in enumerate(df.columns, start=1):
-            max_len = len(str(col_name)) if col_name is not None else 0
+    # NaN/NA -> пустые ячейки (как na_rep="" у DataFrame.to_excel)
+    cells = df.astype(object).where(df.notna(), None)
 
-            for row_idx in range(2, len(df) + 2):  # данные с 2-й строки
-                val = ws.cell(row=row_idx, column=col_idx).value
-                if val is None:
-                    continue
-                max_len = max(max_len, len(str(val)))
+    # write_only: строки пишутся потоком, без графа Cell-объектов на весь лист;
+    # ширины колонок в этом режиме задаются до записи строк
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("result")
+    for col_idx, width in enumerate(_column_widths(df), start=1):
+        ws.column_dimensions[get_column_letter(col_idx)].width = width
 
-            # немного запаса, и ограничим адекватными рамками
-            width = min(max_len + 2, 60)
-            ws.column_dimensions[get_column_letter(col_idx)].width = width
-
-    bio.seek(0)
-    return bio.read()
+    for row in dataframe_to_rows(cells, index=False, header=True):
+        ws.append(row)
 
+    bio = io.BytesIO()
+    wb.save(bio)
+    return bio.getvalue()
@@ -1,4 +1,4 @@
-let pollTimer = null;
+let events = null;
 
 const fileInput = document.getElementById("fileInput");
 const btnUpload = document.getElementById("btnUpload");
@@ -28,6 +28,11 @@ function renderLogs(lines) {
   logBox.scrollTop = logBox.scrollHeight;
 }
 
+function appendLog(line) {
+  logBox.textContent += (logBox.textContent ? "\n" : "") + line;
+  logBox.scrollTop = logBox.scrollHeight;
+}
+
 function resetUI() {
   // сброс визуального состояния страницы
   fileInput.value = "";
@@ -38,11 +43,7 @@ function resetUI() {
   setDownloadEnabled(false);
 }
 
-async function pollStatus() {
-  const r = await fetch("/status", { cache: "no-store" });
-  const st = await r.json();
-
-  renderLogs(st.logs);
+function applyStatus(st) {
   setStatus(
     st.running
       ? `Выполняется... Загружено PDF: ${st.uploaded}`
@@ -51,11 +52,20 @@ async function pollStatus() {
 
   setStartEnabled(!st.running && st.uploaded > 0);
   setDownloadEnabled(st.has_result && !st.running);
+}
 
-  if (!st.running && pollTimer) {
-    clearInterval(pollTimer);
-    pollTimer = null;
-  }
+async function pollStatus() {
+  // логи приходят через /events, здесь только статус
+  const r = await fetch("/status", { cache: "no-store" });
+  applyStatus(await r.json());
+}
+
+function connectEvents() {
+  // SSE: сервер шлёт только новые строки лога и статус после них
+  events = new EventSource("/events");
+  events.addEventListener("reset", () => { logBox.textContent = ""; });
+  events.onmessage = (e) => appendLog(JSON.parse(e.data));
+  events.addEventListener("status", (e) => applyStatus(JSON.parse(e.data)));
 }
 
 btnUpload.addEventListener("click", async () => {
@@ -86,7 +96,6 @@ btnUpload.addEventListener("click", async () => {
 btnStart.addEventListener("click", async () => {
   setStartEnabled(false);
   setDownloadEnabled(false);
-  renderLogs(["Запуск..."]);
   setStatus("Старт...");
 
   const r = await fetch("/start", { method: "POST" });
@@ -97,8 +106,6 @@ btnStart.addEventListener("click", async () => {
     await pollStatus();
     return;
   }
-
-  pollTimer = setInterval(pollStatus, 700);
 });
 
 btnDownload.addEventListener("click", async () => {
@@ -140,5 +147,6 @@ window.addEventListener("beforeunload", () => {
   } catch (e) {}
 });
 
-// первичный статус
+// первичный статус + поток логов
+connectEvents();
 pollStatus();